@@ -11,7 +11,7 @@ from functools import wraps
 import logging
 from io import StringIO
 import threading
-from config import ADMIN_USERNAME, ADMIN_PASSWORD, ADMIN_PORT
+from config import ADMIN_USERNAME, ADMIN_PASSWORD, ADMIN_PORT, LOG_FORMAT
 
 app = Flask(__name__)
 app.secret_key = os.urandom(24)
@@ -20,7 +20,7 @@ app.secret_key = os.urandom(24)
 log_stream = StringIO()
 file_handler = logging.StreamHandler(log_stream)
 file_handler.setLevel(logging.INFO)
-file_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
 
 # Add handlers to all loggers we want to capture
 loggers = [
@@ -271,4 +271,9 @@ def run_admin_panel():
     app.run(host='0.0.0.0', port=ADMIN_PORT, debug=False)
 
 if __name__ == '__main__':
+    # Run standalone, so app.py isn't there to configure logging
+    logging.basicConfig(
+        format=LOG_FORMAT,
+        level=logging.INFO
+    )
     run_admin_panel()
\ No newline at end of file
@@ -8,10 +8,11 @@ import admin_panel
 import telegram_bot
 import monitor_global
 import monitor_au
+from config import LOG_FORMAT
 
 # Enable logging
 logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    format=LOG_FORMAT,
     level=logging.INFO
 )
 logger = logging.getLogger(__name__)
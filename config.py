@@ -15,4 +15,11 @@ ADMIN_PASSWORD = "VeerKrupa"  # Change this in production!
 ADMIN_PORT = 5010
 
 # Monitoring Settings
-CHECK_INTERVAL = 10  # Check every 5 minutes
\ No newline at end of file
+CHECK_INTERVAL = 10  # Check every 5 minutes
+STOCK_CACHE_TTL = 5  # Seconds to reuse a fetched Global stock result
+PRODUCT_CACHE_TTL = 60  # Seconds the bot menus reuse product rows read from the database
+MONITOR_WORKERS = 8  # Concurrent stock requests per monitor; keep within the HTTP pool size
+TRACEBACK_LOG_INTERVAL = 60  # Seconds between full tracebacks logged for the same kind of monitoring error
+
+# Logging Settings
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'  # Log line format, shared by app.py, standalone runs and the admin panel's log view
\ No newline at end of file
@@ -3,8 +3,13 @@ Database models and connection handling
 """
 import sqlite3
 import datetime
+import time
 from contextlib import contextmanager
-from config import DATABASE_PATH
+from config import DATABASE_PATH, PRODUCT_CACHE_TTL
+
+# Recently read product rows for the bot menus, keyed by query and cleared on
+# any product change; values are (monotonic time, rows)
+_product_cache = {}
 
 # Initialize the database
 def init_db():
@@ -86,6 +91,16 @@ def update_user_balance(user_id, amount):
         conn.commit()
         return True
 
+def get_user_and_product(user_id, product_id):
+    """Get a user's balance with a product's name and price, or None if either is missing"""
+    with get_db_connection() as conn:
+        cursor = conn.execute('''
+            SELECT u.balance, p.product_name, p.price 
+            FROM users u, products p 
+            WHERE u.user_id = ? AND p.product_id = ?
+        ''', (user_id, product_id))
+        return cursor.fetchone()
+
 def get_all_users():
     """Get all users"""
     with get_db_connection() as conn:
@@ -101,6 +116,7 @@ def add_product(product_name, global_link, au_link, price):
             (product_name, global_link, au_link, price)
         )
         conn.commit()
+        _product_cache.clear()
         return conn.lastrowid
 
 def get_product(product_id):
@@ -115,6 +131,30 @@ def get_all_products():
         cursor = conn.execute('SELECT * FROM products ORDER BY product_name')
         return cursor.fetchall()
 
+def _get_cached_products(key, load):
+    """Return cached product rows for key, calling load() if they are missing or expired"""
+    cached = _product_cache.get(key)
+    if cached and time.monotonic() - cached[0] < PRODUCT_CACHE_TTL:
+        return cached[1]
+    
+    rows = load()
+    _product_cache[key] = (time.monotonic(), rows)
+    return rows
+
+def get_product_cached(product_id):
+    """Get product information by product_id, reusing a recent read"""
+    return _get_cached_products(("product", product_id), lambda: get_product(product_id))
+
+def get_product_list():
+    """Get the id, name and price of every product, for menus that list them"""
+    with get_db_connection() as conn:
+        cursor = conn.execute('SELECT product_id, product_name, price FROM products ORDER BY product_name')
+        return cursor.fetchall()
+
+def get_product_list_cached():
+    """Get the product list, reusing a recent read"""
+    return _get_cached_products(("list",), get_product_list)
+
 def update_product(product_id, product_name=None, global_link=None, au_link=None, price=None):
     """Update product information"""
     with get_db_connection() as conn:
@@ -136,6 +176,7 @@ def update_product(product_id, product_name=None, global_link=None, au_link=None
             (name, global_url, au_url, new_price, product_id)
         )
         conn.commit()
+        _product_cache.clear()
         return True
 
 # Monitoring operations
@@ -206,6 +247,24 @@ def get_all_active_monitors():
         ''')
         return cursor.fetchall()
 
+def iter_monitored_products():
+    """
+    Yield each product with at least one active monitoring subscription, one
+    row at a time, with the number of those subscriptions and the newest one's ID
+    """
+    with get_db_connection() as conn:
+        cursor = conn.execute('''
+            SELECT p.product_id, p.product_name, p.global_link, p.au_link, 
+                   COUNT(m.id) AS subscription_count, MAX(m.id) AS last_subscription_id 
+            FROM products p 
+            JOIN monitoring m ON m.product_id = p.product_id 
+            JOIN users u ON m.user_id = u.user_id 
+            WHERE m.active = 1 AND m.expiry_date > datetime('now')
+            GROUP BY p.product_id 
+            ORDER BY p.product_name
+        ''')
+        yield from cursor
+
 def cancel_monitoring(monitor_id):
     """Cancel a monitoring subscription"""
     with get_db_connection() as conn:
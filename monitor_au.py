@@ -1,21 +1,31 @@
 """
 Monitoring script for Popmart AU (Shopify-based)
 """
-import requests
-import time
+import functools
+import orjson
 import logging
 import asyncio
-from telegram_bot import notify_users_about_stock
+from concurrent.futures import ThreadPoolExecutor
 import database as db
-from config import CHECK_INTERVAL
+import monitor_loop
+from popmart_api import REQUEST_TIMEOUT, make_session
+from config import MONITOR_WORKERS, LOG_FORMAT
 
-# Enable logging
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
 logger = logging.getLogger(__name__)
 
+# Shared HTTP session; every AU product is on the same store host, so its
+# pool lets each of the executor's workers keep its connection alive
+# between checks, and a failed request is retried instead of failing the
+# product for the whole check interval
+session = make_session()
+
+# Last ETag, Last-Modified and stock result per product .js URL, used for
+# conditional requests
+_validator_cache = {}
+
+# Worker pool for the blocking stock requests of a monitoring scan
+executor = ThreadPoolExecutor(max_workers=MONITOR_WORKERS)
+
 def get_stock_level(item):
     """Determine stock level based on product variant data"""
     if item.get('available') and item.get('inventory_quantity', 0) > 0:
@@ -25,100 +35,115 @@ def get_stock_level(item):
     else:
         return 'Out of stock'
 
+@functools.lru_cache(maxsize=1024)
+def get_product_json_url(url):
+    """Get the Shopify JSON endpoint for a product URL, built once per link"""
+    return url.partition('?')[0] + '.js'
+
 def check_stock(url):
     """Check stock for a given Shopify product URL"""
     # Make sure we're using the JSON endpoint
     if not url:
         return None
         
-    url = url.split('?')[0] + '.js'
+    url = get_product_json_url(url)
     
     try:
-        logger.info(f"Checking stock for: {url}")
-        response = requests.get(url)
+        logger.info("Checking stock for: %s", url)
+        
+        # Ask the store to skip the body if the product hasn't changed since
+        # the last check, and reuse that check's result if so
+        headers = {}
+        cached = _validator_cache.get(url)
+        if cached:
+            etag, last_modified, cached_in_stock = cached
+            if etag:
+                headers["If-None-Match"] = etag
+            if last_modified:
+                headers["If-Modified-Since"] = last_modified
+        
+        response = session.get(url, headers=headers, timeout=REQUEST_TIMEOUT)
+        
+        if response.status_code == 304 and cached:
+            logger.info("Product unchanged since last check, in stock: %s", cached_in_stock)
+            return cached_in_stock
         
         if response.status_code == 200:
-            product_data = response.json()
+            product_data = orjson.loads(response.content)
             product_name = product_data.get('title', 'Unknown Product')
-            logger.info(f"Product: {product_name}")
+            logger.info("Product: %s", product_name)
             
             # Check if any variant is in stock
             in_stock = False
             for variant in product_data.get('variants', []):
                 stock = get_stock_level(variant)
                 variant_name = 'One Size' if variant.get('title') == 'Default Title' else variant.get('title', 'Unknown Variant')
-                logger.info(f"Variant: {variant_name}, Stock: {stock}")
+                logger.info("Variant: %s, Stock: %s", variant_name, stock)
                 
                 if stock != 'Out of stock':
                     in_stock = True
             
+            etag = response.headers.get("ETag")
+            last_modified = response.headers.get("Last-Modified")
+            if etag or last_modified:
+                _validator_cache[url] = (etag, last_modified, in_stock)
+            
             return in_stock
         else:
-            logger.error(f"Error finding product: {response.reason}")
+            logger.error("Error finding product: %s", response.reason)
             return None
     
     except Exception as e:
-        logger.error(f"Error checking stock: {str(e)}")
+        logger.error("Error checking stock: %s", e)
         return None
 
 # The following functions are for running the monitoring asynchronously
 
-async def check_product_async(monitor):
-    """Check a single product asynchronously"""
+async def check_product_async(monitor, future):
+    """Wait for a product's stock check and notify users if it is in stock"""
     try:
-        # Only check AU link
-        au_link = monitor['au_link']
-        if not au_link:
+        # Stock is checked in the worker pool, see check_all_products
+        in_stock = await asyncio.wrap_future(future)
+        if in_stock is None:
+            # The check failed, so keep the last known status rather than
+            # treating the product as out of stock and notifying again later
             return
-            
-        in_stock = check_stock(au_link)
         
         if in_stock:
-            logger.info(f"Product {monitor['product_name']} is in stock on AU!")
-            await notify_users_about_stock(monitor['product_id'], "AU", au_link)
+            logger.info("Product %s is in stock on AU!", monitor['product_name'])
+        await monitor_loop.alert_stock("AU", monitor, in_stock, monitor['au_link'])
     except Exception as e:
-        logger.error(f"Error checking product {monitor.get('product_name', 'unknown')}: {str(e)}")
+        logger.error("Error checking product %s: %s", monitor['product_name'], e)
 
 async def check_all_products():
     """Check all products for stock and notify users"""
     try:
-        monitors = db.get_all_active_monitors()
+        pending = []
         
-        # Process each product sequentially (can be made parallel if needed)
-        for monitor in monitors:
-            await check_product_async(monitor)
-    except Exception as e:
-        logger.error(f"Error checking products: {str(e)}")
-
-async def run_monitoring_loop():
-    """Run continuous monitoring loop"""
-    logger.info("Starting Popmart AU monitoring")
-    
-    while True:
-        try:
-            await check_all_products()
-        except Exception as e:
-            logger.error(f"Error in monitoring loop: {str(e)}")
+        # One row per monitored product, however many users are watching it;
+        # the blocking requests run in the worker pool so products are checked
+        # in parallel instead of one after another on the event loop
+        for monitor in db.iter_monitored_products():
+            # Only check AU link
+            au_link = monitor['au_link']
+            if not au_link:
+                continue
+            
+            pending.append((monitor, executor.submit(check_stock, au_link)))
         
-        # Wait for the next check interval
-        try:
-            await asyncio.sleep(CHECK_INTERVAL)
-        except Exception as e:
-            logger.error(f"Error during sleep: {str(e)}")
-            # If we can't sleep, wait a bit to avoid CPU spinning
-            time.sleep(60)
+        await asyncio.gather(*(check_product_async(monitor, future) for monitor, future in pending))
+        monitor_loop.forget_unmonitored("AU", (monitor['product_id'] for monitor, _ in pending))
+    except Exception as e:
+        logger.error("Error checking products: %s", e)
 
 def start_monitoring():
     """Start the monitoring process"""
-    try:
-        # This is the key fix - create a new event loop for this thread
-        new_loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(new_loop)
-        
-        # Run the monitoring loop
-        new_loop.run_until_complete(run_monitoring_loop())
-    except Exception as e:
-        logger.error(f"Error starting monitoring: {str(e)}")
+    monitor_loop.start_monitoring(check_all_products, "AU", logger)
 
 if __name__ == "__main__":
+    # Run standalone, so app.py isn't there to configure logging
+    logging.basicConfig(
+        format=LOG_FORMAT,
+        level=logging.INFO
+    )
     start_monitoring()
\ No newline at end of file
@@ -0,0 +1,97 @@
+"""
+Monitoring loop shared by the Popmart Global and AU monitors
+"""
+import asyncio
+import time
+from telegram_bot import notify_users_about_stock
+from config import CHECK_INTERVAL, TRACEBACK_LOG_INTERVAL
+
+# Monotonic time each exception type last had its traceback logged
+_traceback_logged_at = {}
+
+def traceback_due(error):
+    """Whether to log a traceback for an error, at most once per interval for each exception type"""
+    # A product that keeps failing would otherwise format the same stack
+    # every check interval; the error message itself is always logged
+    now = time.monotonic()
+    error_type = type(error)
+    logged_at = _traceback_logged_at.get(error_type)
+    if logged_at is not None and now - logged_at < TRACEBACK_LOG_INTERVAL:
+        return False
+    
+    _traceback_logged_at[error_type] = now
+    return True
+
+# Stock alert state of each in-stock product, by site and then database
+# product ID: its subscriptions as (count, newest ID) when last looked up,
+# the monitoring IDs notified since it came into stock, and whether all of
+# them were. An entry lasts while the product stays in stock, so subscribers
+# are alerted once per restock, including anyone who subscribes meanwhile
+_stock_alerts = {}
+
+async def alert_stock(site, monitor, in_stock, url):
+    """Update a product's stock alert state after a successful check, notifying subscribers not yet alerted"""
+    alerts = _stock_alerts.setdefault(site, {})
+    product_id = monitor['product_id']
+    if not in_stock:
+        # Notify everyone again when it comes back into stock
+        alerts.pop(product_id, None)
+        return
+    
+    # Subscribers are only looked up when the product has just come into
+    # stock, its subscriptions changed, or a notification failed last time
+    subscriptions = (monitor['subscription_count'], monitor['last_subscription_id'])
+    alert = alerts.get(product_id)
+    if alert and alert[0] == subscriptions and alert[2]:
+        return
+    
+    notified = alert[1] if alert else set()
+    all_sent = await notify_users_about_stock(product_id, site, url, monitor['product_name'], notified)
+    alerts[product_id] = (subscriptions, notified, all_sent)
+
+def forget_unmonitored(site, product_ids):
+    """Drop the stock alert state of products that weren't in this scan"""
+    # Nobody monitors them any more, and their state would be stale by the
+    # time someone subscribes again
+    alerts = _stock_alerts.get(site, {})
+    for product_id in alerts.keys() - set(product_ids):
+        del alerts[product_id]
+
+async def run_monitoring_loop(check_all_products, site, logger):
+    """Run continuous monitoring loop for one site's check_all_products coroutine"""
+    logger.info("Starting Popmart %s monitoring", site)
+    
+    # Checks are scheduled against a monotonic deadline, so the interval is
+    # measured from the start of each check and unaffected by clock changes
+    deadline = time.monotonic()
+    while True:
+        deadline += CHECK_INTERVAL
+        try:
+            await check_all_products()
+        except Exception as e:
+            logger.error("Error in monitoring loop: %s", e)
+        
+        # Wait for the next check interval
+        try:
+            delay = deadline - time.monotonic()
+            if delay < -CHECK_INTERVAL:
+                # Fell more than a whole interval behind, start over from now
+                # instead of running back-to-back checks to catch up
+                deadline = time.monotonic()
+            await asyncio.sleep(max(0, delay))
+        except Exception as e:
+            logger.error("Error during sleep: %s", e)
+            # If we can't sleep, wait a bit to avoid CPU spinning
+            time.sleep(60)
+
+def start_monitoring(check_all_products, site, logger):
+    """Start the monitoring process on a new event loop for this thread"""
+    try:
+        # Create new event loop for this thread
+        new_loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(new_loop)
+        
+        # Run the monitoring loop
+        new_loop.run_until_complete(run_monitoring_loop(check_all_products, site, logger))
+    except Exception as e:
+        logger.error("Error starting monitoring: %s", e)
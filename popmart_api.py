@@ -0,0 +1,136 @@
+"""
+Helpers shared by the Popmart monitors and the stock checker script: HTTP
+sessions, response handling and Global API request signing
+"""
+import functools
+import hashlib
+import json
+import time
+from types import MappingProxyType
+import orjson
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# PopMart API host and the client key the web shop signs x-sign with
+BASE_URL = "https://prod-global-api.popmart.com"
+CLIENT_KEY = "rmdxjisjk7gwykcix"
+
+# Salt appended to the serialized parameters before the timestamp
+SIGNATURE_SALT = b"W_ak^moHpMla"
+
+# Seconds to wait for a store or the API before giving up on a request
+REQUEST_TIMEOUT = 10
+
+# Shared read-only fallback for missing nested objects in API responses, so
+# lookups don't build a new empty dict each time
+EMPTY_MAPPING = MappingProxyType({})
+
+def make_session():
+    """Create an HTTP session for one module's stock requests"""
+    session = requests.Session()
+    
+    # Requests reuse pooled keep-alive connections instead of a new TCP+TLS
+    # handshake each, with enough of them for a module's worker threads.
+    # Transient failures and rate limiting are retried with exponential
+    # backoff, honouring Retry-After; the jitter keeps the monitors, which
+    # often fail together, from retrying in lockstep. The API's POSTs only
+    # read data, so they are retried too
+    session.mount("https://", HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=16,
+        max_retries=Retry(
+            total=3,
+            backoff_factor=0.5,
+            backoff_jitter=0.5,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=["GET", "POST"]
+        )
+    ))
+    return session
+
+def status_error(response):
+    """Return the {"error": ...} result for an unsuccessful response, or None"""
+    # Error responses are reported without trying to parse their body,
+    # which is often an HTML page rather than JSON
+    if response.status_code != 200:
+        return {"error": f"HTTP {response.status_code}"}
+    return None
+
+def serialize_params(params, method="get"):
+    """Serialize parameters to the JSON bytes the API signs"""
+    # Process parameters based on method
+    if method.lower() == "get":
+        # For GET requests, filter out empty values
+        filtered_params = {key: str(value) for key, value in params.items() if value not in (None, "")}
+        
+        # With only string values, orjson's sorted compact output is byte for
+        # byte what json.dumps produces - unless it contains non-ASCII text or
+        # DEL, which json.dumps escapes and orjson doesn't
+        json_bytes = orjson.dumps(filtered_params, option=orjson.OPT_SORT_KEYS)
+        if json_bytes.isascii() and b"\x7f" not in json_bytes:
+            return json_bytes
+    else:
+        # For POST requests, use all parameters (only read, so no copy needed)
+        filtered_params = params
+    
+    # Compact JSON with keys sorted recursively; sort_keys does this while
+    # encoding instead of rebuilding every nested dict first
+    return json.dumps(filtered_params, separators=(',', ':'), sort_keys=True).encode('utf-8')
+
+def hash_params(json_bytes):
+    """Start an MD5 of the serialized parameters and salt"""
+    # The MD5 is an API checksum, not a security measure
+    signature_hash = hashlib.md5(json_bytes, usedforsecurity=False)
+    signature_hash.update(SIGNATURE_SALT)
+    return signature_hash
+
+@functools.lru_cache(maxsize=256)
+def get_signature_prefix(params_items):
+    """MD5 of the serialized GET parameters and salt, which every timestamp shares"""
+    return hash_params(serialize_params(dict(params_items)))
+
+def generate_signature(params, timestamp, method="get"):
+    """Generate the signature ('s' parameter) for PopMart API"""
+    if method.lower() == "get":
+        # Polling the same GET request only changes the timestamp, so carry on
+        # from a copy of the cached hash of everything before it
+        try:
+            signature_hash = get_signature_prefix(tuple(params.items())).copy()
+        except TypeError:
+            # Unhashable values such as lists can't be cached, but still sign
+            # as their str() like any other GET value
+            signature_hash = hash_params(serialize_params(params))
+    else:
+        signature_hash = hash_params(serialize_params(params, method))
+    
+    # Calculate MD5 hash
+    signature_hash.update(timestamp.encode('ascii'))
+    return signature_hash.hexdigest()
+
+# Last (second, timestamp string) pair handed out by get_timestamp
+_timestamp_cache = (0, "0")
+
+def get_timestamp():
+    """Get the current Unix timestamp string, reused within the same second"""
+    global _timestamp_cache
+    now = int(time.time())
+    if now != _timestamp_cache[0]:
+        _timestamp_cache = (now, str(now))
+    return _timestamp_cache[1]
+
+# Last (timestamp, x-sign header) pair handed out by get_x_sign
+_x_sign_cache = ("", "")
+
+def get_x_sign(timestamp):
+    """Get the x-sign header for a timestamp, reusing it within the same second"""
+    global _x_sign_cache
+    cached = _x_sign_cache
+    if cached[0] == timestamp:
+        return cached[1]
+    
+    x_sign_base = f"{timestamp},{CLIENT_KEY}"
+    x_sign_hash = hashlib.md5(x_sign_base.encode('utf-8'), usedforsecurity=False).hexdigest()
+    x_sign = f"{x_sign_hash},{timestamp}"
+    _x_sign_cache = (timestamp, x_sign)
+    return x_sign
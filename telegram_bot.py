@@ -2,7 +2,11 @@
 Telegram bot functionality for the Popmart monitoring system
 Includes both settings bot and notification bot
 """
+import asyncio
 import logging
+import threading
+import time
+import weakref
 # For compatibility with older python-telegram-bot versions
 try:
     # Try imports for version 20.x
@@ -12,6 +16,7 @@ try:
         Application, CommandHandler, MessageHandler, CallbackQueryHandler,
         ContextTypes, filters
     )
+    from telegram.request import HTTPXRequest
     PTB_VERSION = 20
 except ImportError:
     # Fallback to version 13.x
@@ -25,57 +30,104 @@ except ImportError:
 import database as db
 from config import SETTINGS_BOT_TOKEN, NOTIFICATION_BOT_TOKEN
 
-# Enable logging
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
 logger = logging.getLogger(__name__)
 
+# Telegram allows a bot roughly 30 messages per second across all chats, so
+# notification sends from both monitors are spaced to stay below that
+NOTIFICATIONS_PER_SECOND = 25
+
+# Most notifications for one product in flight at the same time; it bounds
+# open requests, while the pacing above is what respects the rate limit
+MAX_CONCURRENT_NOTIFICATIONS = 25
+
+# Times a notification is tried when Telegram asks the bot to slow down
+NOTIFICATION_ATTEMPTS = 3
+
+# Seconds each getUpdates long poll waits for new updates before returning
+POLLING_TIMEOUT = 30
+
+# The settings bot only handles commands and button presses, so Telegram
+# need not deliver any other kind of update
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
+
+# IDs of users registered in the database since startup
+_registered_users = set()
+
+# Keyboards that never change are built once and shared by every handler
+BACK_TO_MENU_BUTTON = InlineKeyboardButton("⬅️ Back to Menu", callback_data="back_to_menu")
+BACK_TO_MENU_MARKUP = InlineKeyboardMarkup([[BACK_TO_MENU_BUTTON]])
+BACK_TO_PRODUCTS_MARKUP = InlineKeyboardMarkup([[
+    InlineKeyboardButton("⬅️ Back to Products", callback_data="products")
+]])
+MAIN_MENU_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📊 My Balance", callback_data="balance")],
+    [InlineKeyboardButton("🛒 Products to Monitor", callback_data="products")],
+    [InlineKeyboardButton("ℹ️ My Monitoring List", callback_data="my_monitoring")]
+])
+
 # Settings Bot handlers
+async def edit_message(query, text: str, reply_markup=None) -> None:
+    """Edit the message a button belongs to, skipping edits that would not change it"""
+    # The callback query carries the message as currently shown, so a repeat
+    # tap on the same screen needs no request at all. Menus older than about
+    # two days come as an InaccessibleMessage without text, so those are
+    # always edited
+    message = query.message
+    if isinstance(message, telegram.Message) and message.text == text and message.reply_markup == reply_markup:
+        return
+    
+    try:
+        await query.edit_message_text(text, reply_markup=reply_markup)
+    except telegram.error.BadRequest as e:
+        # Two quick taps can both pass the check above; the second edit is a no-op
+        if "not modified" not in str(e).lower():
+            raise
+
 async def start_command(update: Update, context) -> None:
     """Handle the /start command - register user and show main menu"""
     user = update.effective_user
     
-    # Register user in database if not already registered
-    db.add_user(user.id, user.username or user.first_name)
+    # Register user in database if not already registered; users seen since
+    # startup are remembered so a repeated /start skips the database
+    if user.id not in _registered_users:
+        db.add_user(user.id, user.username or user.first_name)
+        _registered_users.add(user.id)
     
     await show_main_menu(update, context)
 
 async def show_main_menu(update: Update, context) -> None:
     """Show the main menu with buttons"""
-    keyboard = [
-        [InlineKeyboardButton("📊 My Balance", callback_data="balance")],
-        [InlineKeyboardButton("🛒 Products to Monitor", callback_data="products")],
-        [InlineKeyboardButton("ℹ️ My Monitoring List", callback_data="my_monitoring")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
     await update.effective_message.reply_text(
         "Welcome to the Popmart Monitoring Bot!\n\n"
         "What would you like to do?",
-        reply_markup=reply_markup
+        reply_markup=MAIN_MENU_MARKUP
     )
 
 async def button_handler(update: Update, context) -> None:
     """Handle button clicks"""
     query = update.callback_query
-    await query.answer()
     
-    if query.data == "balance":
-        await show_balance(update, context)
-    elif query.data == "products":
-        await show_products(update, context)
-    elif query.data == "my_monitoring":
-        await show_my_monitoring(update, context)
-    elif query.data.startswith("monitor_"):
-        product_id = int(query.data.split("_")[1])
-        await confirm_monitoring(update, context, product_id)
-    elif query.data.startswith("confirm_"):
-        product_id = int(query.data.split("_")[1])
-        await add_monitoring(update, context, product_id)
-    elif query.data == "back_to_menu":
-        await show_main_menu(update, context)
+    # Answer the callback as a task rather than waiting a round-trip for it
+    # first; it makes progress whenever the handler awaits, so the answer and
+    # the handler's own Telegram request overlap
+    answer = asyncio.create_task(query.answer())
+    try:
+        if query.data == "balance":
+            await show_balance(update, context)
+        elif query.data == "products":
+            await show_products(update, context)
+        elif query.data == "my_monitoring":
+            await show_my_monitoring(update, context)
+        elif query.data.startswith("monitor_"):
+            product_id = int(query.data.split("_")[1])
+            await confirm_monitoring(update, context, product_id)
+        elif query.data.startswith("confirm_"):
+            product_id = int(query.data.split("_")[1])
+            await add_monitoring(update, context, product_id)
+        elif query.data == "back_to_menu":
+            await show_main_menu(update, context)
+    finally:
+        await answer
 
 async def show_balance(update: Update, context) -> None:
     """Show user's current balance"""
@@ -84,27 +136,23 @@ async def show_balance(update: Update, context) -> None:
     
     user = db.get_user(user_id)
     
-    keyboard = [[InlineKeyboardButton("⬅️ Back to Menu", callback_data="back_to_menu")]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    await query.edit_message_text(
+    await edit_message(
+        query,
         f"Your current balance: ${user['balance']:.2f}\n\n"
         "Note: Balance can only be added by an administrator.",
-        reply_markup=reply_markup
+        reply_markup=BACK_TO_MENU_MARKUP
     )
 
 async def show_products(update: Update, context) -> None:
     """Show list of available products to monitor"""
     query = update.callback_query
-    products = db.get_all_products()
+    products = db.get_product_list_cached()
     
     if not products:
-        keyboard = [[InlineKeyboardButton("⬅️ Back to Menu", callback_data="back_to_menu")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await query.edit_message_text(
+        await edit_message(
+            query,
             "No products available for monitoring yet.",
-            reply_markup=reply_markup
+            reply_markup=BACK_TO_MENU_MARKUP
         )
         return
     
@@ -117,10 +165,11 @@ async def show_products(update: Update, context) -> None:
             )
         ])
     
-    keyboard.append([InlineKeyboardButton("⬅️ Back to Menu", callback_data="back_to_menu")])
+    keyboard.append([BACK_TO_MENU_BUTTON])
     reply_markup = InlineKeyboardMarkup(keyboard)
     
-    await query.edit_message_text(
+    await edit_message(
+        query,
         "Select a product to monitor:",
         reply_markup=reply_markup
     )
@@ -130,8 +179,8 @@ async def confirm_monitoring(update: Update, context, product_id: int) -> None:
     query = update.callback_query
     user_id = query.from_user.id
     
-    user = db.get_user(user_id)
-    product = db.get_product(product_id)
+    # Balance, product name and price in a single query
+    details = db.get_user_and_product(user_id, product_id)
     
     keyboard = [
         [InlineKeyboardButton("✅ Confirm", callback_data=f"confirm_{product_id}")],
@@ -139,21 +188,21 @@ async def confirm_monitoring(update: Update, context, product_id: int) -> None:
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
-    if user['balance'] < product['price']:
-        await query.edit_message_text(
-            f"You want to monitor: {product['product_name']}\n"
-            f"Price: ${product['price']:.2f}\n\n"
-            f"Your balance: ${user['balance']:.2f}\n\n"
+    if details['balance'] < details['price']:
+        await edit_message(
+            query,
+            f"You want to monitor: {details['product_name']}\n"
+            f"Price: ${details['price']:.2f}\n\n"
+            f"Your balance: ${details['balance']:.2f}\n\n"
             "⚠️ You don't have sufficient balance for this monitoring subscription.",
-            reply_markup=InlineKeyboardMarkup([[
-                InlineKeyboardButton("⬅️ Back to Products", callback_data="products")
-            ]])
+            reply_markup=BACK_TO_PRODUCTS_MARKUP
         )
     else:
-        await query.edit_message_text(
-            f"You want to monitor: {product['product_name']}\n"
-            f"Price: ${product['price']:.2f}\n\n"
-            f"Your balance: ${user['balance']:.2f}\n\n"
+        await edit_message(
+            query,
+            f"You want to monitor: {details['product_name']}\n"
+            f"Price: ${details['price']:.2f}\n\n"
+            f"Your balance: ${details['balance']:.2f}\n\n"
             "This will monitor the product for 30 days. Proceed?",
             reply_markup=reply_markup
         )
@@ -165,20 +214,19 @@ async def add_monitoring(update: Update, context, product_id: int) -> None:
     
     success, message = db.add_monitoring(user_id, product_id)
     
-    keyboard = [[InlineKeyboardButton("⬅️ Back to Menu", callback_data="back_to_menu")]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
     if success:
-        product = db.get_product(product_id)
-        await query.edit_message_text(
+        product = db.get_product_cached(product_id)
+        await edit_message(
+            query,
             f"✅ Success! You are now monitoring: {product['product_name']}\n\n"
             "You will receive notifications when this product is in stock.",
-            reply_markup=reply_markup
+            reply_markup=BACK_TO_MENU_MARKUP
         )
     else:
-        await query.edit_message_text(
+        await edit_message(
+            query,
             f"❌ Error: {message}",
-            reply_markup=reply_markup
+            reply_markup=BACK_TO_MENU_MARKUP
         )
 
 async def show_my_monitoring(update: Update, context) -> None:
@@ -188,24 +236,26 @@ async def show_my_monitoring(update: Update, context) -> None:
     
     user_monitoring = db.get_user_monitoring(user_id)
     
-    keyboard = [[InlineKeyboardButton("⬅️ Back to Menu", callback_data="back_to_menu")]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
     if not user_monitoring:
-        await query.edit_message_text(
+        await edit_message(
+            query,
             "You are not monitoring any products yet.",
-            reply_markup=reply_markup
+            reply_markup=BACK_TO_MENU_MARKUP
         )
         return
     
-    message = "Your active monitoring subscriptions:\n\n"
+    # Collect the lines and join once rather than growing the string per subscription
+    lines = ["Your active monitoring subscriptions:\n\n"]
     
     for monitor in user_monitoring:
-        message += f"• {monitor['product_name']} (expires: {monitor['expiry_date']})\n"
+        lines.append(f"• {monitor['product_name']} (expires: {monitor['expiry_date']})\n")
     
-    await query.edit_message_text(
+    message = "".join(lines)
+    
+    await edit_message(
+        query,
         message,
-        reply_markup=reply_markup
+        reply_markup=BACK_TO_MENU_MARKUP
     )
 
 async def help_command(update: Update, context) -> None:
@@ -216,42 +266,141 @@ async def help_command(update: Update, context) -> None:
     )
 
 # Notification Bot functionality
-async def send_notification(user_id: int, message: str) -> None:
-    """Send notification to a user"""
-    try:
+
+# Notification bots by event loop. A bot keeps its HTTP connections open
+# between notifications, but they belong to the loop they were made on and
+# the Global and AU monitors each run their own loop
+_notification_bots = weakref.WeakKeyDictionary()
+
+def get_notification_bot():
+    """Return the notification bot for the running event loop, creating it on first use"""
+    loop = asyncio.get_running_loop()
+    bot = _notification_bots.get(loop)
+    if bot is None:
         if PTB_VERSION >= 20:
-            # For v20.x, we need to create a new application each time
-            bot = telegram.Bot(token=NOTIFICATION_BOT_TOKEN)
-            await bot.send_message(chat_id=user_id, text=message)
+            # The default request keeps a single connection, which the
+            # concurrent sends of notify_users_about_stock would queue on
+            # until they time out
+            request = HTTPXRequest(connection_pool_size=MAX_CONCURRENT_NOTIFICATIONS)
+            bot = telegram.Bot(token=NOTIFICATION_BOT_TOKEN, request=request)
         else:
-            # For older versions
-            import telegram
             bot = telegram.Bot(token=NOTIFICATION_BOT_TOKEN)
-            bot.send_message(chat_id=user_id, text=message)
-        return True
-    except Exception as e:
-        logger.error(f"Error sending notification: {e}")
-        return False
+        _notification_bots[loop] = bot
+    return bot
+
+# Monotonic time the next notification may be sent at, and the time until
+# which Telegram has asked the bot to stop sending. The Global and AU monitors
+# send from their own threads and loops, so both are shared through a lock
+_next_send_at = 0.0
+_sends_paused_until = 0.0
+_send_schedule_lock = threading.Lock()
+
+def _reserve_send_slot():
+    """Reserve the next free send time and return how long to wait for it"""
+    global _next_send_at
+    with _send_schedule_lock:
+        now = time.monotonic()
+        send_at = max(now, _next_send_at)
+        _next_send_at = send_at + 1 / NOTIFICATIONS_PER_SECOND
+    return send_at - now
+
+def _pause_sends(seconds):
+    """Hold every notification, including ones already waiting for a slot, for the given seconds"""
+    global _next_send_at, _sends_paused_until
+    with _send_schedule_lock:
+        _sends_paused_until = max(_sends_paused_until, time.monotonic() + seconds)
+        _next_send_at = max(_next_send_at, _sends_paused_until)
+
+async def _wait_for_send_slot():
+    """Wait for a send slot that doesn't fall inside a rate limit pause"""
+    while True:
+        await asyncio.sleep(_reserve_send_slot())
+        # A pause may have started while this send waited for its slot
+        if time.monotonic() >= _sends_paused_until:
+            return
+
+async def send_notification(user_id: int, message: str) -> None:
+    """Send notification to a user, retrying when Telegram rate limits the bot"""
+    for attempt in range(NOTIFICATION_ATTEMPTS):
+        try:
+            await _wait_for_send_slot()
+            bot = get_notification_bot()
+            if PTB_VERSION >= 20:
+                await bot.send_message(chat_id=user_id, text=message)
+            else:
+                # For older versions
+                bot.send_message(chat_id=user_id, text=message)
+            return True
+        except telegram.error.RetryAfter as e:
+            # Newer python-telegram-bot versions give a timedelta
+            delay = e.retry_after
+            if hasattr(delay, "total_seconds"):
+                delay = delay.total_seconds()
+            logger.warning("Rate limited sending notification to %s, retrying in %s seconds", user_id, delay)
+            _pause_sends(delay)
+        except Exception as e:
+            logger.error("Error sending notification: %s", e)
+            return False
+    
+    logger.error("Error sending notification: still rate limited after %s attempts", NOTIFICATION_ATTEMPTS)
+    return False
+
+async def _send_notification_limited(semaphore, user_id: int, message: str) -> None:
+    """Send a notification once the semaphore has a free slot"""
+    async with semaphore:
+        return await send_notification(user_id, message)
 
 # Function to notify users about stock availability
-async def notify_users_about_stock(product_id: int, site: str, url: str) -> None:
-    """Notify all users monitoring a product when it's in stock"""
+async def notify_users_about_stock(product_id: int, site: str, url: str, product_name: str = None, notified: set = None) -> bool:
+    """
+    Notify all users monitoring a product when it's in stock, returning
+    whether every notification was sent. If a set of already notified
+    monitoring IDs is given, only the other subscriptions are notified and
+    the set is updated with the ones that were
+    """
     try:
-        product = db.get_product(product_id)
-        if not product:
-            return
+        # Callers that already have the product row can pass its name to skip a lookup
+        if product_name is None:
+            product = db.get_product(product_id)
+            if not product:
+                return False
+            product_name = product['product_name']
         
         monitors = db.get_product_monitors(product_id)
+        if notified is not None:
+            # Forget subscriptions that have lapsed, so renewing one alerts again
+            notified.intersection_update(monitor['id'] for monitor in monitors)
+            monitors = [monitor for monitor in monitors if monitor['id'] not in notified]
+            if not monitors:
+                logger.debug("All users monitoring product %s already notified", product_id)
+                return True
         
-        for monitor in monitors:
-            message = (
-                f"🔔 {product['product_name']} is now in stock on Popmart {site}!\n\n"
-                f"Click here to view: {url}\n\n"
-                f"Hurry! Stock may be limited."
-            )
-            await send_notification(monitor['user_id'], message)
+        # The message is the same for every subscriber, so build it once
+        message = (
+            f"🔔 {product_name} is now in stock on Popmart {site}!\n\n"
+            f"Click here to view: {url}\n\n"
+            f"Hurry! Stock may be limited."
+        )
+        
+        # The semaphore is created per call because each monitor runs its own
+        # event loop in a separate thread
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_NOTIFICATIONS)
+        
+        # Queue every subscriber's send at once rather than waiting on each
+        # Telegram request in turn; send_notification paces them and handles
+        # its own failures
+        results = await asyncio.gather(*(
+            _send_notification_limited(semaphore, monitor['user_id'], message)
+            for monitor in monitors
+        ))
+        
+        if notified is not None:
+            # Failed sends are left out so they are retried on the next check
+            notified.update(monitor['id'] for monitor, sent in zip(monitors, results) if sent)
+        return all(results)
     except Exception as e:
-        logger.error(f"Error notifying users: {str(e)}")
+        logger.error("Error notifying users: %s", e)
+        return False
 
 
 # Settings bot setup
@@ -267,7 +416,7 @@ def run_settings_bot():
         application.add_handler(CallbackQueryHandler(button_handler))
         
         # Start the Bot
-        application.run_polling(allowed_updates=Update.ALL_TYPES)
+        application.run_polling(allowed_updates=ALLOWED_UPDATES, timeout=POLLING_TIMEOUT)
         
         return application
     else:
@@ -281,7 +430,7 @@ def run_settings_bot():
         dispatcher.add_handler(CallbackQueryHandler(button_handler))
         
         # Start the Bot
-        updater.start_polling()
+        updater.start_polling(timeout=POLLING_TIMEOUT, allowed_updates=ALLOWED_UPDATES)
         updater.idle()
         
         return updater
\ No newline at end of file
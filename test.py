@@ -1,70 +1,25 @@
-import hashlib
-import json
+import functools
 import time
-import requests
+import orjson
 import csv
-from concurrent.futures import ThreadPoolExecutor
+from types import MappingProxyType
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from popmart_api import (
+    BASE_URL, CLIENT_KEY, EMPTY_MAPPING, REQUEST_TIMEOUT,
+    generate_signature, get_timestamp, get_x_sign, make_session, status_error
+)
 
-def generate_signature(params, timestamp, method="get"):
-    """Generate the signature ('s' parameter) for PopMart API"""
-    # Process parameters based on method
-    if method.lower() == "get":
-        # For GET requests, filter out empty values
-        filtered_params = {}
-        for key, value in params.items():
-            if value is not None and value != "":
-                filtered_params[key] = str(value)
-    else:
-        # For POST requests, use all parameters
-        filtered_params = params.copy()
-    
-    # Sort object's keys recursively
-    def sort_object(obj):
-        if isinstance(obj, dict):
-            return {k: sort_object(obj[k]) for k in sorted(obj.keys())}
-        elif isinstance(obj, list):
-            return [sort_object(item) for item in obj]
-        else:
-            return obj
-    
-    sorted_params = sort_object(filtered_params)
-    
-    # Generate the string to hash - using compact JSON
-    salt = "W_ak^moHpMla"
-    json_string = json.dumps(sorted_params, separators=(',', ':'))
-    string_to_hash = f"{json_string}{salt}{timestamp}"
-    
-    # Calculate MD5 hash
-    signature = hashlib.md5(string_to_hash.encode('utf-8')).hexdigest()
-    return signature
+# One pooled session for every request, so check_all_stock's worker threads
+# reuse keep-alive connections instead of a new TCP+TLS handshake per call
+session = make_session()
 
-def make_api_request(endpoint, params, method="get", country="AU", language="en"):
-    """Make an API request to PopMart API"""
-    base_url = "https://prod-global-api.popmart.com"
-    url = f"{base_url}{endpoint}"
-    
-    # Generate timestamp
-    timestamp = str(int(time.time()))
-    
-    # Generate signature
-    signature = generate_signature(params, timestamp, method)
-    
-    # Add signature and timestamp to parameters
-    request_params = params.copy()
-    request_params["s"] = signature
-    request_params["t"] = timestamp
-    
-    # Generate x-sign header
-    client_key = "rmdxjisjk7gwykcix"
-    x_sign_base = f"{timestamp},{client_key}"
-    x_sign_hash = hashlib.md5(x_sign_base.encode('utf-8')).hexdigest()
-    x_sign = f"{x_sign_hash},{timestamp}"
-    
-    # Set headers
-    headers = {
+@functools.lru_cache(maxsize=16)
+def get_base_headers(country, language):
+    """Headers shared by every request for a country and language, built once"""
+    return MappingProxyType({
         "accept": "application/json, text/plain, */*",
         "accept-language": f"en-{country},en-US;q=0.9,en;q=0.8",
-        "clientkey": client_key,
+        "clientkey": CLIENT_KEY,
         "country": country,
         "language": language,
         "origin": "https://www.popmart.com",
@@ -75,17 +30,39 @@ def make_api_request(endpoint, params, method="get", country="AU", language="en"
         "x-client-namespace": "eurasian",
         "x-device-os-type": "web",
         "x-project-id": "eude",
-        "x-sign": x_sign,
         "tz": f"Australia/Sydney"
-    }
+    })
+
+def make_api_request(endpoint, params, method="get", country="AU", language="en"):
+    """Make an API request to PopMart API"""
+    url = f"{BASE_URL}{endpoint}"
+    
+    # Generate timestamp
+    timestamp = get_timestamp()
+    
+    # Generate signature
+    signature = generate_signature(params, timestamp, method)
+    
+    # Add signature and timestamp to parameters
+    request_params = params.copy()
+    request_params["s"] = signature
+    request_params["t"] = timestamp
+    
+    # Only x-sign changes between requests
+    headers = {**get_base_headers(country, language), "x-sign": get_x_sign(timestamp)}
     
     try:
         if method.lower() == "get":
-            response = requests.get(url, params=request_params, headers=headers)
+            response = session.get(url, params=request_params, headers=headers, timeout=REQUEST_TIMEOUT)
         else:
-            response = requests.post(url, json=request_params, headers=headers)
+            response = session.post(url, json=request_params, headers=headers, timeout=REQUEST_TIMEOUT)
         
-        return response.json()
+        error = status_error(response)
+        if error:
+            print(f"Error making request to {endpoint}: {error['error']}")
+            return error
+        
+        return orjson.loads(response.content)
     except Exception as e:
         print(f"Error making request to {endpoint}: {str(e)}")
         return {"error": str(e)}
@@ -125,18 +102,18 @@ def get_all_category_ids(country="AU", language="en"):
     
     return category_ids
 
-def get_all_products(country="AU", language="en"):
+def get_listing_product_ids(category_id=None, country="AU", language="en"):
     """
-    Get all products by iterating through all pages and categories
-    Returns a list of product IDs
+    Get the product IDs on every page of one listing, either a category or
+    all products when category_id is None
     """
-    all_product_ids = set()
+    listing = "all products" if category_id is None else f"category {category_id}"
+    product_ids = []
     
-    # Try with no category first (all products)
     page = 1
     while True:
-        print(f"Fetching page {page} of all products...")
-        response = get_product_list(None, page, 100, country, language)
+        print(f"Fetching page {page} of {listing}...")
+        response = get_product_list(category_id, page, 100, country, language)
         
         try:
             products = response.get("data", {}).get("results", [])
@@ -144,33 +121,36 @@ def get_all_products(country="AU", language="en"):
                 break
                 
             for product in products:
-                all_product_ids.add(product.get("id"))
+                product_ids.append(product.get("id"))
                 
             page += 1
         except:
-            print(f"Error processing page {page}")
+            print(f"Error processing page {page} of {listing}")
             break
     
-    # Also try with each category to ensure we get everything
-    categories = get_all_category_ids(country, language)
-    for category_id in categories:
-        page = 1
-        while True:
-            print(f"Fetching page {page} for category {category_id}...")
-            response = get_product_list(category_id, page, 100, country, language)
-            
-            try:
-                products = response.get("data", {}).get("results", [])
-                if not products:
-                    break
-                    
-                for product in products:
-                    all_product_ids.add(product.get("id"))
-                    
-                page += 1
-            except:
-                print(f"Error processing page {page} for category {category_id}")
-                break
+    return product_ids
+
+def get_all_products(country="AU", language="en", max_workers=5):
+    """
+    Get all products by iterating through all pages and categories
+    Returns a list of product IDs
+    """
+    # Insertion-ordered dict of int IDs, so "938" and 938 count as one product
+    # and the scan order is stable between runs
+    all_product_ids = {}
+    
+    # Try with no category (all products) and also with each category to
+    # ensure we get everything. The listings are fetched side by side; pages
+    # within one listing stay in order since it ends at the first empty page
+    listings = [None] + get_all_category_ids(country, language)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for product_ids in executor.map(
+            lambda category_id: get_listing_product_ids(category_id, country, language),
+            listings
+        ):
+            for product_id in product_ids:
+                if product_id is not None:
+                    all_product_ids[int(product_id)] = None
     
     return list(all_product_ids)
 
@@ -193,6 +173,7 @@ def get_product_stock_info(product_id, country="AU", language="en"):
         
         sku_info = []
         for sku in skus:
+            stock = sku.get("stock") or EMPTY_MAPPING
             sku_info.append({
                 "sku_id": sku.get("id"),
                 "sku_title": sku.get("title"),
@@ -200,14 +181,14 @@ def get_product_stock_info(product_id, country="AU", language="en"):
                 "price": sku.get("price"),
                 "discount_price": sku.get("discountPrice"),
                 "currency": sku.get("currency"),
-                "stock": sku.get("stock", {}).get("onlineStock", 0),
-                "lock_stock": sku.get("stock", {}).get("onlineLockStock", 0)
+                "stock": stock.get("onlineStock", 0),
+                "lock_stock": stock.get("onlineLockStock", 0)
             })
         
         return {
             "product_id": product_id,
             "title": product_data.get("title", "Unknown"),
-            "brand": product_data.get("brand", {}).get("name"),
+            "brand": (product_data.get("brand") or EMPTY_MAPPING).get("name"),
             "publish_status": "Published" if product_data.get("isPublish") else "Not Published",
             "availability": "Available" if product_data.get("isAvailable") else "Not Available",
             "sku_count": len(skus),
@@ -223,86 +204,88 @@ def get_product_stock_info(product_id, country="AU", language="en"):
             "skus": []
         }
 
+# Columns of the stock CSV, one row per SKU
+CSV_FIELDS = (
+    "product_id", "title", "brand", "publish_status", "availability",
+    "sku_id", "sku_title", "sku_code", "price", "discount_price", "currency",
+    "stock", "lock_stock"
+)
+
+def product_rows(product):
+    """Yield a product's CSV rows in CSV_FIELDS order, one per SKU or a single row if it has none"""
+    base = (
+        product["product_id"],
+        product["title"],
+        product.get("brand", ""),
+        product.get("publish_status", ""),
+        product.get("availability", ""),
+    )
+    
+    if product["sku_count"] == 0:
+        # No SKUs, add a single row
+        yield base + ("", "", "", "", "", "", 0, 0)
+    else:
+        # Add a row for each SKU
+        for sku in product["skus"]:
+            yield base + (
+                sku["sku_id"],
+                sku["sku_title"],
+                sku["sku_code"],
+                sku["price"],
+                sku["discount_price"],
+                sku["currency"],
+                sku["stock"],
+                sku["lock_stock"]
+            )
+
+# How many products check_all_stock processes between progress lines
+PROGRESS_EVERY = 100
+
 def check_all_stock(country="AU", language="en", max_workers=5):
     """Check stock for all products and save to CSV"""
-    product_ids = get_all_products(country, language)
+    product_ids = get_all_products(country, language, max_workers)
     print(f"Found {len(product_ids)} products. Fetching stock information...")
     
-    all_results = []
-    
-    # Use threading to speed up the process
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        # Create a future for each product ID
-        future_to_id = {
-            executor.submit(get_product_stock_info, product_id, country, language): product_id 
-            for product_id in product_ids
-        }
-        
-        # Process results as they complete
-        for i, future in enumerate(future_to_id):
-            try:
-                result = future.result()
-                all_results.append(result)
-                print(f"Processed {i+1}/{len(product_ids)}: {result['title']}")
-            except Exception as e:
-                product_id = future_to_id[future]
-                print(f"Error processing product {product_id}: {str(e)}")
-    
-    # Save all results to CSV
     timestamp = time.strftime("%Y%m%d_%H%M%S")
     filename = f"popmart_stock_{country}_{timestamp}.csv"
     
-    # First, create a flat version of the data for CSV
-    flat_data = []
-    for product in all_results:
-        if product["sku_count"] == 0:
-            # No SKUs, add a single row
-            flat_data.append({
-                "product_id": product["product_id"],
-                "title": product["title"],
-                "brand": product.get("brand", ""),
-                "publish_status": product.get("publish_status", ""),
-                "availability": product.get("availability", ""),
-                "sku_id": "",
-                "sku_title": "",
-                "sku_code": "",
-                "price": "",
-                "discount_price": "",
-                "currency": "",
-                "stock": 0,
-                "lock_stock": 0
-            })
-        else:
-            # Add a row for each SKU
-            for sku in product["skus"]:
-                flat_data.append({
-                    "product_id": product["product_id"],
-                    "title": product["title"],
-                    "brand": product.get("brand", ""),
-                    "publish_status": product.get("publish_status", ""),
-                    "availability": product.get("availability", ""),
-                    "sku_id": sku["sku_id"],
-                    "sku_title": sku["sku_title"],
-                    "sku_code": sku["sku_code"],
-                    "price": sku["price"],
-                    "discount_price": sku["discount_price"],
-                    "currency": sku["currency"],
-                    "stock": sku["stock"],
-                    "lock_stock": sku["lock_stock"]
-                })
+    all_results = []
     
-    # Write to CSV
+    # Each product's rows are written to the CSV as its result comes in,
+    # rather than flattening everything after the scan
     with open(filename, 'w', newline='', encoding='utf-8') as f:
-        if flat_data:
-            writer = csv.DictWriter(f, fieldnames=list(flat_data[0].keys()))
-            writer.writeheader()
-            writer.writerows(flat_data)
+        # Rows are plain tuples in column order, which skips DictWriter's
+        # per-field dict lookups
+        writer = csv.writer(f)
+        writer.writerow(CSV_FIELDS)
+        
+        # Use threading to speed up the process
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            # Create a future for each product ID
+            future_to_id = {
+                executor.submit(get_product_stock_info, product_id, country, language): product_id 
+                for product_id in product_ids
+            }
+            
+            # Process results as they complete, reporting progress every
+            # PROGRESS_EVERY products rather than printing a line per product
+            total = len(product_ids)
+            for i, future in enumerate(as_completed(future_to_id), 1):
+                try:
+                    result = future.result()
+                    all_results.append(result)
+                    writer.writerows(product_rows(result))
+                    if i % PROGRESS_EVERY == 0 or i == total:
+                        print(f"Processed {i}/{total}: {result['title']}")
+                except Exception as e:
+                    product_id = future_to_id[future]
+                    print(f"Error processing product {product_id}: {str(e)}")
     
     print(f"Stock information saved to {filename}")
     
     # Also save the raw JSON data for reference
-    with open(f"popmart_stock_{country}_{timestamp}.json", 'w', encoding='utf-8') as f:
-        json.dump(all_results, f, indent=2, ensure_ascii=False)
+    with open(f"popmart_stock_{country}_{timestamp}.json", 'wb') as f:
+        f.write(orjson.dumps(all_results, option=orjson.OPT_INDENT_2))
     
     return all_results
 